@@ -1,99 +1,161 @@
 import os
-import json
 import time
 import random
 import datetime as dt
+from concurrent.futures import Future, ThreadPoolExecutor
 from zoneinfo import ZoneInfo
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2.extras import Json
 
 
 WB_URL = "https://seller-analytics-api.wildberries.ru/api/v2/search-report/table/details"
 
-
-def msk_today() -> dt.date:
-    return dt.datetime.now(ZoneInfo("Europe/Moscow")).date()
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
 
 
-def safe_get(obj: Dict[str, Any], path: Tuple[str, ...], default=None):
-    cur: Any = obj
-    for k in path:
-        if not isinstance(cur, dict) or k not in cur:
-            return default
-        cur = cur[k]
-    return cur
+def orjson_dumps(obj: Any) -> str:
+    return orjson.dumps(obj).decode("utf-8")
 
 
-def is_retryable_http(code: int) -> bool:
-    return code in (429, 500, 502, 503, 504)
+def msk_today() -> dt.date:
+    return dt.datetime.now(ZoneInfo("Europe/Moscow")).date()
 
 
-def fetch_page_with_retry(
-    session: requests.Session,
-    token: str,
+class WbRetry(Retry):
+    """urllib3 Retry с экспонентой, потолком и full jitter с первого же ретрая и логом каждой попытки."""
+
+    def __init__(self, *args, rate_limit_sleep_sec: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        # минимальная пауза после 429 без Retry-After
+        self.rate_limit_sleep_sec = rate_limit_sleep_sec
+
+    def new(self, **kw) -> "WbRetry":
+        # urllib3 пересоздаёт Retry на каждой попытке и про свои параметры подклассов не знает
+        kw.setdefault("rate_limit_sleep_sec", self.rate_limit_sleep_sec)
+        return super().new(**kw)
+
+    def get_backoff_time(self) -> float:
+        # у urllib3 первый ретрай идёт без паузы — против лимита 3 req/min это сжигает квоту
+        attempt = len(self.history)
+        if attempt == 0:
+            return 0.0
+        # full jitter: параллельные воркеры не ретраят синхронно
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** (attempt - 1))))
+
+    def sleep(self, response=None) -> None:
+        sleep_s = None
+        if self.respect_retry_after_header and response is not None:
+            # Retry-After: секунды или HTTP-дата
+            sleep_s = self.get_retry_after(response)
+        if not sleep_s and response is not None and response.status == 429:
+            # без Retry-After: ждём сброса окна по X-RateLimit-*, но не меньше WB_SLEEP_SEC,
+            # иначе короткий backoff против лимита 3 req/min просто сжигает попытки
+            sleep_s = max(rate_limit_wait(response, self.rate_limit_sleep_sec), self.rate_limit_sleep_sec)
+        if not sleep_s:
+            sleep_s = self.get_backoff_time()
+
+        attempt = len(self.history)
+        last = self.history[-1] if self.history else None
+        if last is not None and last.status is not None:
+            last_err = f"HTTP {last.status}"
+        else:
+            last_err = f"Network/Timeout: {last.error if last is not None else None}"
+        print(f"⚠️ {last_err}. Retry {attempt}/{attempt + (self.total or 0)} after {sleep_s:.1f}s", flush=True)
+        time.sleep(sleep_s)
+
+
+def make_retry(max_retries: int, base_backoff_sec: float, max_backoff_sec: float, sleep_sec: float) -> Retry:
+    # ретраи сетевых ошибок и 429/5xx делает urllib3, в т.ч. с учётом Retry-After;
+    # WB_MAX_RETRIES — всего попыток, как и раньше, а urllib3 считает только повторы
+    return WbRetry(
+        total=max(0, max_retries - 1),
+        rate_limit_sleep_sec=sleep_sec,
+        backoff_factor=base_backoff_sec,
+        backoff_max=max_backoff_sec,
+        status_forcelist=RETRYABLE_STATUSES,
+        allowed_methods=frozenset(["POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def make_session(token: str, retry: Retry) -> requests.Session:
+    # одна keep-alive сессия на весь прогон: без нового TLS-рукопожатия на каждую страницу
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": token,
+        "Content-Type": "application/json",
+        # ответ — JSON с повторяющимися ключами, сжимается в разы; распаковывает urllib3 (br — через Brotli)
+        "Accept-Encoding": "gzip, deflate, br",
+    })
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry))
+    return session
+
+
+def rate_limit_wait(r: Any, fallback_sec: float) -> float:
+    """Сколько ждать перед следующим запросом по заголовкам X-RateLimit-*."""
+    try:
+        remaining = float(r.headers["X-RateLimit-Remaining"])
+        reset = float(r.headers.get("X-RateLimit-Reset", "0"))
+    except (KeyError, ValueError):
+        # сервер не сообщил квоту (или прислал мусор) — держим прежний фиксированный темп
+        return fallback_sec
+    if remaining > 0:
+        return 0.0
+    if reset <= 0:
+        # квота исчерпана, но когда она сбросится — неизвестно: фиксированный темп, а не запрос сразу в 429
+        return fallback_sec
+    # reset бывает как unix-временем, так и числом секунд до сброса окна
+    if reset > 1e9:
+        reset -= time.time()
+    return max(0.0, reset)
+
+
+def build_payload(
     report_date: dt.date,
-    offset: int,
     limit: int,
     position_cluster: str,
     include_substituted_skus: bool,
     include_search_texts: bool,
     order_field: str,
     order_mode: str,
-    timeout_sec: int,
-    max_retries: int,
-    base_backoff_sec: float,
-) -> List[Dict[str, Any]]:
-    past_date = report_date - dt.timedelta(days=1)
-
-    payload = {
-        "currentPeriod": {"start": report_date.isoformat(), "end": report_date.isoformat()},
-        "pastPeriod": {"start": past_date.isoformat(), "end": past_date.isoformat()},
+) -> Dict[str, Any]:
+    """Тело запроса для одной даты; между страницами меняется только offset."""
+    curr = report_date.isoformat()
+    past = (report_date - dt.timedelta(days=1)).isoformat()
+    return {
+        "currentPeriod": {"start": curr, "end": curr},
+        "pastPeriod": {"start": past, "end": past},
         "orderBy": {"field": order_field, "mode": order_mode},
         "positionCluster": position_cluster,
         "includeSubstitutedSKUs": include_substituted_skus,
         "includeSearchTexts": include_search_texts,
         "limit": limit,
-        "offset": offset,
-    }
-
-    headers = {
-        "Authorization": token,
-        "Content-Type": "application/json",
+        "offset": 0,
     }
 
-    last_err = None
-
-    for attempt in range(1, max_retries + 1):
-        try:
-            r = session.post(WB_URL, headers=headers, json=payload, timeout=timeout_sec)
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
-            last_err = f"Network/Timeout: {e}"
-            sleep_s = base_backoff_sec * (2 ** (attempt - 1)) + random.uniform(0, 1.0)
-            print(f"⚠️ {last_err}. Retry {attempt}/{max_retries} after {sleep_s:.1f}s", flush=True)
-            time.sleep(sleep_s)
-            continue
-
-        if r.status_code >= 400:
-            if is_retryable_http(r.status_code):
-                last_err = f"HTTP {r.status_code}: {r.text[:300]}"
-                if r.status_code == 429:
-                    sleep_s = max(30.0, base_backoff_sec * (2 ** (attempt - 1))) + random.uniform(0, 1.5)
-                else:
-                    sleep_s = base_backoff_sec * (2 ** (attempt - 1)) + random.uniform(0, 1.0)
-                print(f"⚠️ {last_err}. Retry {attempt}/{max_retries} after {sleep_s:.1f}s", flush=True)
-                time.sleep(sleep_s)
-                continue
-
-            raise RuntimeError(f"HTTP {r.status_code}: {r.text}")
 
-        data = r.json()
-        products = safe_get(data, ("data", "products"), default=[])
-        return products if isinstance(products, list) else []
+def fetch_page(
+    session: requests.Session,
+    payload: Dict[str, Any],
+    timeout_sec: int,
+    sleep_sec: float,
+) -> Tuple[List[Dict[str, Any]], float]:
+    r = session.post(WB_URL, data=orjson.dumps(payload), timeout=timeout_sec)
+    if r.status_code >= 400:
+        raise RuntimeError(f"HTTP {r.status_code}: {r.text}")
 
-    raise RuntimeError(f"Failed after {max_retries} retries. Last error: {last_err}")
+    data = orjson.loads(r.content)
+    body = data.get("data") if isinstance(data, dict) else None
+    products = body.get("products") if isinstance(body, dict) else None
+    products = products if isinstance(products, list) else []
+    return products, rate_limit_wait(r, sleep_sec)
 
 
 def upsert_raw_items(
@@ -105,41 +167,143 @@ def upsert_raw_items(
     order_field: str,
     order_mode: str,
     products: List[Dict[str, Any]],
+    batch_size: int,
 ) -> int:
     if not products:
         return 0
 
-    rows = []
-    for p in products:
-        nm_id = p.get("nmId")
-        if nm_id is None:
-            continue
-        rows.append([
-            report_date,
-            position_cluster,
-            include_substituted_skus,
-            include_search_texts,
-            order_field,
-            order_mode,
-            int(nm_id),
-            json.dumps(p, ensure_ascii=False),
-        ])
-
+    # строки разворачивает сервер из одного jsonb-массива на батч: в Python нет работы на строку.
+    # Один nmId дважды в одном insert ... on conflict даёт "cannot affect row a second time",
+    # поэтому distinct on оставляет последнее вхождение
     sql = """
     insert into public.wb_search_products_daily_raw
       (report_date, position_cluster, include_substituted_skus, include_search_texts, order_field, order_mode, nm_id, raw_item)
-    values %s
+    select distinct on (nm_id) %s, %s, %s, %s, %s, %s, nm_id, elem
+    from (
+      select (elem->>'nmId')::numeric::bigint as nm_id, elem, ord
+      from jsonb_array_elements(%s::jsonb) with ordinality as t(elem, ord)
+      where elem->>'nmId' is not null
+    ) s
+    order by nm_id, ord desc
     on conflict (report_date, position_cluster, include_substituted_skus, include_search_texts, order_field, order_mode, nm_id)
     do update set
       load_dttm = now(),
-      raw_item  = excluded.raw_item::jsonb
+      raw_item  = excluded.raw_item
     ;
     """
 
+    n = 0
     with conn.cursor() as cur:
-        execute_values(cur, sql, rows, page_size=1000)
-    conn.commit()
-    return len(rows)
+        # ~1000 строк на insert — дальше Postgres не ускоряется, а на десятках тысяч начинает проседать
+        for i in range(0, len(products), batch_size):
+            cur.execute(sql, (
+                report_date,
+                position_cluster,
+                include_substituted_skus,
+                include_search_texts,
+                order_field,
+                order_mode,
+                Json(products[i:i + batch_size], dumps=orjson_dumps),
+            ))
+            n += cur.rowcount
+    return n
+
+
+def sync_date(
+    session: requests.Session,
+    conn,
+    executor: ThreadPoolExecutor,
+    report_date: dt.date,
+    wait_s: float,
+    limit: int,
+    position_cluster: str,
+    include_substituted_skus: bool,
+    include_search_texts: bool,
+    order_field: str,
+    order_mode: str,
+    timeout_sec: int,
+    sleep_sec: float,
+    batch_size: int,
+) -> Tuple[int, float]:
+    """Выгружает все страницы одной даты. Возвращает число строк и паузу перед следующим запросом."""
+    print(f"\n=== report_date={report_date} ===", flush=True)
+
+    payload = build_payload(
+        report_date=report_date,
+        limit=limit,
+        position_cluster=position_cluster,
+        include_substituted_skus=include_substituted_skus,
+        include_search_texts=include_search_texts,
+        order_field=order_field,
+        order_mode=order_mode,
+    )
+    offset = 0
+    total_upserted = 0
+    pending: Optional[Future] = None
+
+    while True:
+        # пауза нужна только перед следующим запросом, а не после последней страницы
+        if wait_s > 0:
+            print(f"[{report_date}] Rate limit: wait {wait_s:.1f}s", flush=True)
+            time.sleep(wait_s)
+
+        print(f"[{report_date}] Fetch offset={offset} limit={limit}", flush=True)
+
+        payload["offset"] = offset
+        products, wait_s = fetch_page(
+            session=session,
+            payload=payload,
+            timeout_sec=timeout_sec,
+            sleep_sec=sleep_sec,
+        )
+
+        if not products:
+            break
+
+        # не больше одной незавершённой записи: ошибки БД всплывают сразу
+        if pending is not None:
+            total_upserted += pending.result()
+
+        pending = executor.submit(
+            upsert_raw_items,
+            conn=conn,
+            report_date=report_date,
+            position_cluster=position_cluster,
+            include_substituted_skus=include_substituted_skus,
+            include_search_texts=include_search_texts,
+            order_field=order_field,
+            order_mode=order_mode,
+            products=products,
+            batch_size=batch_size,
+        )
+
+        # если меньше лимита — последняя страница
+        if len(products) < limit:
+            break
+
+        offset += limit
+
+    if pending is not None:
+        total_upserted += pending.result()
+
+    # одна транзакция на дату: commit тоже через executor, в том же потоке, что и запись
+    executor.submit(conn.commit).result()
+
+    print(f"Done report_date={report_date}. Upserted: {total_upserted}", flush=True)
+    return total_upserted, wait_s
+
+
+def sync_date_isolated(token: str, dsn: str, retry: Retry, report_date: dt.date, **params) -> int:
+    """sync_date со своей сессией и своим подключением к БД — для параллельного режима."""
+    session = make_session(token, retry)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, ThreadPoolExecutor(max_workers=1) as executor:
+            total_upserted, _ = sync_date(session, conn, executor, report_date, 0.0, **params)
+    finally:
+        conn.close()
+        session.close()
+    return total_upserted
 
 
 def main():
@@ -156,69 +320,55 @@ def main():
 
     limit = int(os.getenv("WB_LIMIT", "500"))
     sleep_sec = float(os.getenv("WB_SLEEP_SEC", "25"))
+    batch_size = int(os.getenv("DB_BATCH_SIZE", "1000"))
+    if batch_size < 1:
+        raise ValueError(f"DB_BATCH_SIZE must be >= 1, got {batch_size}")
 
     timeout_sec = int(os.getenv("WB_TIMEOUT_SEC", "90"))
     max_retries = int(os.getenv("WB_MAX_RETRIES", "6"))
     base_backoff_sec = float(os.getenv("WB_BACKOFF_SEC", "5"))
+    max_backoff_sec = float(os.getenv("WB_MAX_BACKOFF", "60"))
+
+    # даты параллельно — только если лимит WB считается не глобально на токен
+    parallel_dates = os.getenv("WB_PARALLEL_DATES", "0") == "1"
 
     today = msk_today()
     dates = [(today - dt.timedelta(days=i)) for i in range(1, days_back + 1)]
 
     scope = f"includeSearchTexts={include_search_texts}, includeSubstitutedSKUs={include_substituted}"
     print(f"MSK today: {today} | DAYS_BACK={days_back} | {scope}", flush=True)
-    print(f"Reload dates: {dates}", flush=True)
-
-    session = requests.Session()
-
-    with psycopg2.connect(dsn) as conn:
+    print(f"Reload dates: {dates} | parallel={parallel_dates}", flush=True)
+
+    retry = make_retry(max_retries, base_backoff_sec, max_backoff_sec, sleep_sec)
+
+    params = dict(
+        limit=limit,
+        position_cluster=position_cluster,
+        include_substituted_skus=include_substituted,
+        include_search_texts=include_search_texts,
+        order_field=order_field,
+        order_mode=order_mode,
+        timeout_sec=timeout_sec,
+        sleep_sec=sleep_sec,
+        batch_size=batch_size,
+    )
+
+    if not dates:
+        return
+
+    if parallel_dates:
+        with ThreadPoolExecutor(max_workers=len(dates)) as pool:
+            list(pool.map(lambda d: sync_date_isolated(token, dsn, retry, d, **params), dates))
+        return
+
+    session = make_session(token, retry)
+    wait_s = 0.0
+
+    # conn используется только потоком executor'а: запись в БД идёт в фоне, пока основной поток
+    # ждёт лимит и качает следующую страницу
+    with psycopg2.connect(dsn) as conn, ThreadPoolExecutor(max_workers=1) as executor:
         for report_date in dates:
-            print(f"\n=== report_date={report_date} ===", flush=True)
-
-            offset = 0
-            total_upserted = 0
-
-            while True:
-                print(f"Fetch offset={offset} limit={limit}", flush=True)
-
-                products = fetch_page_with_retry(
-                    session=session,
-                    token=token,
-                    report_date=report_date,
-                    offset=offset,
-                    limit=limit,
-                    position_cluster=position_cluster,
-                    include_substituted_skus=include_substituted,
-                    include_search_texts=include_search_texts,
-                    order_field=order_field,
-                    order_mode=order_mode,
-                    timeout_sec=timeout_sec,
-                    max_retries=max_retries,
-                    base_backoff_sec=base_backoff_sec,
-                )
-
-                if not products:
-                    break
-
-                n = upsert_raw_items(
-                    conn=conn,
-                    report_date=report_date,
-                    position_cluster=position_cluster,
-                    include_substituted_skus=include_substituted,
-                    include_search_texts=include_search_texts,
-                    order_field=order_field,
-                    order_mode=order_mode,
-                    products=products,
-                )
-                total_upserted += n
-
-                # если меньше лимита — последняя страница
-                if len(products) < limit:
-                    break
-
-                offset += limit
-                time.sleep(sleep_sec)
-
-            print(f"Done report_date={report_date}. Upserted: {total_upserted}", flush=True)
+            _, wait_s = sync_date(session, conn, executor, report_date, wait_s, **params)
 
 
 if __name__ == "__main__":